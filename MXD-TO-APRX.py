@@ -3,42 +3,84 @@
 ## Created by: Brandon Katz
 ## Purpose: Convert map documents to ArcGIS Pro Projects to prepare for new publishing workflows in ArcGIS Enterprise 11.1 and later
 ## Setup:
-##    1. Replace paths, URLs, and values in lines 155-156.
+##    1. Replace paths, URLs, and values in the production and debug dictionaries at the start of the main block.
 ##    2. Prepare a template ArcGIS Pro Project named 'Template' without a map within it. The result should be a file named 'Template.aprx' within a folder named 'Template'.
+##       Only 'Template.aprx' is used. It is opened once per worker process and saved as a copy for each service. Other files in the folder are ignored.
 ##    3. If utilizing the metadata features in a run, prepare a CSV file including desired information. Fields should include Title, Summary, Description, and Tags.
 
-import os, sys, shutil, glob, csv, atexit
+import os, sys, csv, atexit, logging, logging.handlers, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from arcpy import mp
 from arcpy import metadata as md
-from arcgis.gis.server.catalog import ServicesDirectory
+from services_cache import load_services_cached
 
-def log_error(error,e):
+logger = logging.getLogger("MXD-TO-APRX")
+windows_max_workers = 61 # ProcessPoolExecutor does not allow more worker processes on Windows
+md_fields = ["service", "summary", "description", "tags"] # Metadata.csv columns, in order. The service name is also used as the title
 
-    tb = sys.exc_info()[2]
-    log_output["ERRORS"].append(" ".join([error,f"ERROR @ LINE: {tb.tb_lineno}",f"ERROR DETAILS: {e}"]))
+def configure_logger(log_queue, verbose):
+
+    """Sends this process's log records to the queue read by the listener in the main process. Debug messages are only sent in verbose runs. Replaces any existing handler, as worker processes started by fork inherit the main process's handler."""
+
+    logger.handlers.clear()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
 
     return
 
-def aprx_cleanup(aprx_delete):
-    
-    """Removes copied Template.aprx files from newly created ArcGIS Pro Projects if failed during normal processing. Included due to differences in file locking behavior from ArcGIS Pro 3.1.0 to 3.1.1"""
+def start_logging(verbose):
+
+    """Starts a listener in a background thread that writes log records from the main process and the worker processes to the console. Returns the queue the worker processes should log to."""
+
+    log_queue = multiprocessing.Queue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop) # Writes any remaining log records before the program exits
+    configure_logger(log_queue, verbose)
+
+    return log_queue
+
+def log(category, message):
 
-    for aprx in aprx_delete:
-        os.remove(aprx)
+    """Writes a categorized line to the output log. The log file is buffered and flushed every 50 lines or when the category changes, so little is lost if the program stops unexpectedly."""
+
+    log_state["file"].write(f"{category}: {message}\n")
+    log_state["counts"][category] += 1
+    log_state["unflushed"] += 1
+    if log_state["unflushed"] >= 50 or category != log_state["category"]:
+        log_state["file"].flush()
+        log_state["unflushed"] = 0
+    log_state["category"] = category
+
+    return
+
+def log_error(error,e,errors=None):
+
+    """Formats an error with the line it was raised from. Appends it to the given error list (used in worker processes), otherwise writes it to the output log."""
+
+    lineno = e.__traceback__.tb_lineno if e.__traceback__ else -1 # Read from the exception itself rather than the thread's exception state
+    message = " ".join([error,f"ERROR @ LINE: {lineno}",f"ERROR DETAILS: {e}"])
+    if errors is None:
+        log("ERRORS", message)
+    else:
+        errors.append(message)
+
+    return
 
 def get_services():
     
-    """Accesses REST Services Directory via URL to obtain a list of all published services, then filters out any that are not non-cached map services."""
+    """Accesses REST Services Directory via URL (or the local services cache, if recent) to obtain a list of all published services, then filters out any that are not non-cached map services."""
 
     try:
-        print("\tAccessing services directory...")
-        services_directory = ServicesDirectory(mode["rest_url"])
-        services = [service.url.split('/')[-2] for service in services_directory.list() if "MapServer" in service.url and not '"singleFusedMapCache": true' in str(service.properties)]
-        print(f"\t\t{len(services)} services received.")
+        logger.info("\tAccessing services directory...")
+        services = [service["url"].split('/')[-2] for service in load_services_cached(mode["rest_url"], refresh=refresh_cache) if "MapServer" in service["url"] and not service["cached"]]
+        logger.info(f"\t\t{len(services)} services received.")
     except Exception as e:
         error = "ERROR: Could not access services directory."
         log_error(error, e)
-        print("\t\tERROR: Could not access services directory. Program will terminate.")
+        logger.error("\t\tERROR: Could not access services directory. Program will terminate.")
         exit()
 
     return services
@@ -52,10 +94,10 @@ def check_args(services):
             input_args = sys.argv[2].split(",")
             service_names = [service for service in input_args if service in services]
             unmatched = [service for service in input_args if not service in services]
-            print(f"\tNumber of input values matched to published service names: {len(service_names)}")
+            logger.info(f"\tNumber of input values matched to published service names: {len(service_names)}")
             if len(unmatched) > 0:
-                log_output["ERRORS"].append(" ".join(["ERROR: One or more input values did not match a published service name.", f"Number of unmatched input values: {len(unmatched)}", f"Unmatched input values: {unmatched}"]))
-                print(f"\tNumber of input values not matched to published service names: {len(unmatched)}\n\t\tView MXD-TO-APRX_output.txt for details on unmatched input values.")
+                log("ERRORS", " ".join(["ERROR: One or more input values did not match a published service name.", f"Number of unmatched input values: {len(unmatched)}", f"Unmatched input values: {unmatched}"]))
+                logger.info(f"\tNumber of input values not matched to published service names: {len(unmatched)}\n\t\tView MXD-TO-APRX_output.txt for details on unmatched input values.")
         else:
             if len(sys.argv) > 3:
                 start = sys.argv[2]
@@ -64,31 +106,107 @@ def check_args(services):
                 start = 0
                 end = sys.argv[2]
             service_names = services[int(start):int(end)]
-        print(f"\tThis run will include the following: {new_line}\t\t{', '.join(service_names)}")
+        logger.info(f"\tThis run will include the following: {new_line}\t\t{', '.join(service_names)}")
     else:
         service_names = services
 
     return service_names
 
-def mxd_to_aprx(mode, service, error_hold):
+def load_metadata(folder):
+
+    """Reads the metadata CSV in the given folder once into a dictionary keyed by the lowercase service name so each service can be matched without re-reading the file. Reads the file as UTF-8, or in the system encoding if it is not UTF-8 (such as a CSV saved from Excel). Terminates the program if the file cannot be read."""
+
+    md_path = os.path.join(folder, "Metadata.csv")
+    try:
+        try:
+            with open(md_path, "r", newline="", encoding="utf-8-sig") as md_file:
+                md_map = {row["service"].strip().lower(): row for row in csv.DictReader(md_file, fieldnames=md_fields, restval="", delimiter=",")}
+        except UnicodeDecodeError:
+            with open(md_path, "r", newline="") as md_file:
+                md_map = {row["service"].strip().lower(): row for row in csv.DictReader(md_file, fieldnames=md_fields, restval="", delimiter=",")}
+    except (OSError, UnicodeDecodeError) as e:
+        error = f"ERROR: Could not read {md_path}."
+        log_error(error, e)
+        logger.error(f"\t\tERROR: Could not read {md_path}. Program will terminate.")
+        exit()
+
+    return md_map
+
+def get_workers():
+
+    """Removes the optional --workers argument and its value from the input arguments and returns the number of conversion processes to run. Defaults to the number of CPU cores (at most 61). Returns None if the value is missing, is not a whole number greater than 0, or is above 61 on Windows."""
+
+    workers = min(os.cpu_count() or 1, windows_max_workers)
+    if "--workers" in sys.argv:
+        index = sys.argv.index("--workers")
+        value = sys.argv[index + 1] if len(sys.argv) > index + 1 else ""
+        del sys.argv[index:index + 2]
+        workers = int(value) if value.isdecimal() and int(value) > 0 else None
+        if workers is not None and sys.platform == "win32" and workers > windows_max_workers:
+            workers = None
+
+    return workers
 
-    """Copies the contents of the Template ArcGIS Pro Project folder to a new folder named the same as the service. Imports the old map document to the copied Template.aprx file, saves the imported map as the same name as the service, then copies the file again to a new file named the same as the service. Removes the copied Template.aprx file that is no longer needed."""
+def print_usage():
+
+    """Shows the accepted input arguments."""
+
+    logger.info("\nSpecify p (for production) or d (for debug) as the first argument, followed by optional specification arguments.\n")
+    logger.info("<path-to-file> p\n\tRuns in production mode\n\n<path-to-file> d\n\tRuns in debug/test mode\n\n<path-to-file> p 10\n\tRuns in production mode, gets first 10 services\n\tNo range checking implemented\n\n<path-to-file> d 2 15\n\tRuns in debug mode, gets services 2-14\n\tNo range checking implemented\n\n<path-to-file> p ServiceName\n\tRuns in production mode, gets one specified service\n\tCase-sensitive\n\n<path-to-file> d ServiceName,Service_Name,servicename\n\tRuns in debug mode, gets multiple specified services\n\tCase-sensitive\n\tMust be separated by commas (no space after)\n\n<path-to-file> p --workers 4\n\tRuns in production mode, converts up to 4 services at the same time\n\tMust be a whole number greater than 0, and no more than 61 on Windows (defaults to the number of CPU cores, up to 61)\n")
+
+    return
+
+def get_refresh_cache():
+
+    """Removes the optional --refresh-cache argument from the input arguments and returns whether the services cache should be ignored."""
+
+    if "--refresh-cache" in sys.argv:
+        sys.argv.remove("--refresh-cache")
+        return True
+
+    return False
+
+def get_verbose():
+
+    """Removes the optional -v or --verbose argument from the input arguments and returns whether debug messages should be shown."""
+
+    verbose = False
+    for flag in ("-v", "--verbose"):
+        if flag in sys.argv:
+            sys.argv.remove(flag)
+            verbose = True
+
+    return verbose
+
+def init_worker(mode, log_queue, verbose):
+
+    """Routes the worker process's log records to the main process, then opens the Template ArcGIS Pro Project once per worker process so each service only needs to save a copy of it."""
+
+    global template_aprx
+    configure_logger(log_queue, verbose)
+    template_aprx = mp.ArcGISProject(os.path.join(mode["template_folder"], mode["template_aprx"]))
+
+    return
+
+def mxd_to_aprx(mode, md_map, service):
+
+    """Saves a copy of the Template ArcGIS Pro Project to a new folder and file named the same as the service. Imports the old map document into the new APRX file, names the imported map the same as the service, then saves the project. Runs in a worker process, so nothing is shared with the main process. Returns the service name and a list of errors encountered."""
+
+    error_hold = []
 
     def get_metadata(service):
         
-        """Searches CSV for metadata relevant to the service. Uses the service name as metadata if no results are found."""
-
-        print(f"\t\t\tGetting metadata for {service}...")
-        md_csv = list(csv.reader(open("Metadata.csv", "r"), delimiter=","))
-        service_md = [i for i in md_csv if service.lower() == str(i[0]).strip(" ").lower()]
-        if len(service_md) > 0:
-            if type(service_md[0]) == list:
-                service_md = service_md[0]
-                print("\t\t\t\tMetadata found.")
+        """Looks up metadata relevant to the service from the parsed CSV. Uses the service name as metadata if no results are found."""
+
+        logger.debug(f"\t\t\tGetting metadata for {service}...")
+        row = md_map.get(service.lower())
+        if row is not None:
+            service_md = [row[field] for field in md_fields]
+            logger.debug("\t\t\t\tMetadata found.")
         else:
             service_md = [service, service, service, service]
             error_hold.append(f"ERROR: Could not locate metadata for {service}")
-            print(f"\t\t\t\tNo metadata found.")
+            logger.debug(f"\t\t\t\tNo metadata found.")
 
         return service_md
 
@@ -97,7 +215,7 @@ def mxd_to_aprx(mode, service, error_hold):
         """Applies metadata to map."""
 
         try:
-            print(f"\t\t\tSetting metadata for {service}...")
+            logger.debug(f"\t\t\tSetting metadata for {service}...")
             metadata = md.Metadata()
             metadata.title = map_md[0]
             metadata.summary = map_md[1]
@@ -108,101 +226,101 @@ def mxd_to_aprx(mode, service, error_hold):
             if not map_md.isReadOnly:
                 map_md.copy(metadata)
                 map_md.save()
-                print("\t\t\t\tMetadata set.")    
+                logger.debug("\t\t\t\tMetadata set.")
             else:
                 error_hold.append(f"Error setting metadata for {service}")
-                print(f"\t\t\t\tError setting metadata for {service}")
+                logger.error(f"\t\t\t\tError setting metadata for {service}")
         except Exception as e:
             error = f"ERROR: {service}"
-            log_error(error, e)
-            print(f"\t\t\t\tError setting metadata for {service}")
+            log_error(error, e, error_hold)
+            logger.error(f"\t\t\t\tError setting metadata for {service}")
 
         return        
     
     try:
         service_folder = os.path.join(mode["parent_folder"], service)
-        copy_aprx = os.path.join(service_folder, mode["template_aprx"])
         service_aprx = os.path.join(service_folder, service + ".aprx")
-        mxd_path = mode["parent_folder"] + service + ".mxd"
-        shutil.copytree(mode["template_folder"], service_folder) # Copies the template ArcGIS Pro Project folder contents to new folder with a name similar to the service
-        aprx = mp.ArcGISProject(copy_aprx)
+        mxd_path = os.path.join(mode["parent_folder"], service + ".mxd")
+        os.makedirs(service_folder) # Creates a new folder with a name similar to the service
+        template_aprx.saveACopy(service_aprx) # Saves the template APRX opened by this worker to an APRX file with a name similar to the service
+        aprx = mp.ArcGISProject(service_aprx)
         aprx.importDocument(mxd_path) # Imports map document file (MXD) into ArcGIS Pro Project file (APRX)
         map = aprx.listMaps()[0]
         map.name = service # Sets the map name similar to the service
         if mode["metadata"] is True:
             map_md = get_metadata(service)
             set_metadata(service,map,map_md)
-        aprx.saveACopy(service_aprx) # Copies the copied template APRX file to an APRX file with a name similar to the service
+        aprx.save()
         del aprx
-        try:
-            os.remove(copy_aprx) # Delete copied template APRX file
-        except Exception as e:
-            error = f"ERROR: Cannot delete {os.path.join(mode['template_folder'], mode['template_aprx'])}. Will attempt again at program completion. Check service folder for verification of removal."
-            log_error(error,e)
-            aprx_trash.append(copy_aprx)
     except Exception as e:
         error = f"ERROR: {service}"
-        log_error(error, e)
-        print(f"\t\t\tERROR: {service}")
+        log_error(error, e, error_hold)
+        logger.error(f"\t\t\tERROR: {service}")
 
-    return
+    return service, error_hold
 
 if __name__ == "__main__":
 
     # Initialization
     
-    print("\n\nStarting process...\n")
+    workers = get_workers()
+    refresh_cache = get_refresh_cache()
+    log_queue = start_logging(get_verbose())
+    logger.info("\n\nStarting process...\n")
     production = {"rest_url":"<URL>", "parent_folder": "<C:\\PATH\\TO\\FOLDER\\>","output_log_folder": "<C:\\PATH\\TO\\FOLDER\\>", "template_folder": "<C:\\PATH\\TO\\FOLDER\\>", "template_aprx": "Template.aprx", "credits": "<VALUE>", "metadata": False}
     debug = {"rest_url":"<URL>", "parent_folder": "<C:\\PATH\\TO\\FOLDER\\>", "output_log_folder": "<C:\\PATH\\TO\\FOLDER\\>", "template_folder": "<C:\\PATH\\TO\\FOLDER\\>", "template_aprx": "Template.aprx", "credits": "<VALUE>", "metadata": False}
-    log_output = {"COMPLETED":[],"SKIPPED":[],"ERRORS":[]}
     new_line = '\n'
-    aprx_trash = []
+    if workers is None:
+        logger.error(f"\nERROR: --workers must be followed by a whole number greater than 0{f' and no more than {windows_max_workers}' if sys.platform == 'win32' else ''}.")
+        print_usage()
+        exit()
     if len(sys.argv) > 1 and sys.argv[1] == "p":
         mode = production
     elif len(sys.argv) > 1 and sys.argv[1] == "d":
         mode = debug
     else:
-        print("\nSpecify p (for production) or d (for debug) as the first argument, followed by optional specification arguments.\n")
-        print("<path-to-file> p\n\tRuns in production mode\n\n<path-to-file> d\n\tRuns in debug/test mode\n\n<path-to-file> p 10\n\tRuns in production mode, gets first 10 services\n\tNo range checking implemented\n\n<path-to-file> d 2 15\n\tRuns in debug mode, gets services 2-14\n\tNo range checking implemented\n\n<path-to-file> p ServiceName\n\tRuns in production mode, gets one specified service\n\tCase-sensitive\n\n<path-to-file> d ServiceName,Service_Name,servicename\n\tRuns in debug mode, gets multiple specified services\n\tCase-sensitive\n\tMust be separated by commas (no space after)\n")
+        print_usage()
         exit()
+    log_state = {"file": open(os.path.join(mode["output_log_folder"], "MXD-TO-APRX_output.txt"), 'w', buffering=65536), "category": None, "unflushed": 0, "counts": {"COMPLETED":0,"SKIPPED":0,"ERRORS":0}}
+    atexit.register(log_state["file"].close) # Flushes any remaining log lines, including when the program terminates early
 
     # Processing
 
     services = get_services()
     service_names = check_args(services)
-    print("\tAttempting conversions from MXD to APRX...")
-    os.chdir(mode["parent_folder"]) 
-    service_mxds = [mxd[:-4] for mxd in glob.glob("*.mxd")]
-    for service in service_names:
-        error_hold = []
-        if service in service_mxds:
+    logger.info("\tAttempting conversions from MXD to APRX...")
+    md_map = load_metadata(mode["parent_folder"]) if mode["metadata"] is True else {}
+    with os.scandir(mode["parent_folder"]) as entries:
+        service_mxds = {entry.name[:-4] for entry in entries if entry.is_file() and entry.name.lower().endswith(".mxd")}
+    work_list = [service for service in service_names if service in service_mxds]
+    missing = [service for service in service_names if not service in service_mxds]
+    if len(missing) > 0:
+        for service in missing:
+            log("SKIPPED", service)
+        for service in missing:
+            log("ERRORS", f"ERROR: {service} was skipped because no matching mxd file was found")
+        logger.info(f"\t\tNo MXD found for {len(missing)} service(s)... Skipped: {', '.join(missing)}")
+    logger.info(f"\t\tStarting {len(work_list)} conversion(s) across {workers} worker process(es)...")
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(mode, log_queue, logger.level == logging.DEBUG)) as executor:
+        futures = {service: executor.submit(mxd_to_aprx, mode, md_map, service) for service in work_list} # Each worker imports arcpy and opens the template once and is reused for multiple services
+        for service, future in futures.items():
             try:
-                print(f"\t\tStarting {service} conversion...")
-                mxd_to_aprx(mode, service, error_hold)
+                service, error_hold = future.result()
                 if len(error_hold) > 0:
-                    log_output["ERRORS"].append(" ".join([f"{service} errors:", f"{new_line.join(error_hold)}"]))
-                log_output["COMPLETED"].append(f"{service}")
-                print(f"\t\t\t{service} conversion complete.")
+                    log("ERRORS", " ".join([f"{service} errors:", f"{new_line.join(error_hold)}"]))
+                log("COMPLETED", f"{service}")
+                logger.info(f"\t\t\t{service} conversion complete.")
             except Exception as e:
                 error = f"ERROR: {service}"
-                log_output["SKIPPED"].append(service)
+                log("SKIPPED", service)
                 log_error(error, e)
-                print(f"\t\t{service} encountered an error.")
-        else:
-            error = f"ERROR: {service} was skipped because no matching mxd file was found"
-            log_output["SKIPPED"].append(service)
-            log_output["ERRORS"].append(error)
-            print(f"\t\tNo MXD found for {service}... Skipped.")
+                logger.error(f"\t\t{service} encountered an error.")
     
     # Post-Processing
 
-    atexit.register(aprx_cleanup,aprx_trash)
-    if len(log_output) < 1:
-        print("\nProcess completed without errors.\n\n")
+    log_state["file"].flush()
+    if log_state["counts"]["ERRORS"] < 1:
+        logger.info("\nProcess completed without errors.\n\n")
     else:
-        error_count = len(log_output["ERRORS"])
-        os.chdir(mode["log_output_folder"])
-        with open("MXD-TO-APRX_output.txt", 'w') as output:
-            for key, value in log_output.items():
-                output.write(f"{key}:{new_line}{new_line.join(value)}{new_line}{new_line}")
-        print(f"\nProcess completed with {error_count} error(s)...\n\tView MXD-TO-APRX_output.txt for error details.\n\n")
\ No newline at end of file
+        error_count = log_state["counts"]["ERRORS"]
+        logger.info(f"\nProcess completed with {error_count} error(s)...\n\tView MXD-TO-APRX_output.txt for error details.\n\n")
\ No newline at end of file
@@ -6,7 +6,8 @@
 ## Processes:
 ##  1. Start a log file
 ##  2. Get a list of running, non-cached, public map services from an ArcGIS REST services directory
-##  3. For each service, pass it to a function that tries to overwrite the service
+##  3. For each service, pass it to a function that tries to overwrite the service. Services are built and staged on one
+##     thread pool (stage_workers) while staged services are uploaded on another (upload_workers)
 ##      Note: The starting script has the lines passing the service to the overwrite function commented
 ##            so that you can test listing the services first, as overwriting should be done with caution.
 ##            When you are ready to overwrite services, you can uncomment those lines
@@ -19,6 +20,7 @@
 ##        -Stage the Service (convert the .sddraft to an .sd file)
 ##        -Upload/Publish the Service
 ##  4. If the overwrite function is successful, continue to the next service, if not successful, stop the script
+##      (services already being staged or uploaded finish, remaining services are skipped)
 ##
 ## Important:
 ##    Use this script with caution: It is intended to overwrite ArcGIS Map Services.
@@ -36,11 +38,29 @@
 
 # import libraries
 import arcpy
+import atexit
 import os
 import sys
 import datetime
-import xml.dom.minidom as DOM
-from arcgis.gis.server.catalog import ServicesDirectory
+import logging
+import logging.handlers
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# lxml parses and writes the .sddraft files much faster than minidom. minidom is used if lxml is not installed
+# (xml.etree.ElementTree is not used, as it drops the typens namespace declaration the .sddraft file relies on)
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+    import xml.dom.minidom as DOM
+from services_cache import load_services_cached
+
+# Serializes log writes from the overwrite threads
+log_lock = threading.Lock()
+
+# Console messages are queued by the overwrite threads and written by a single listener thread
+logger = logging.getLogger("overwrite_map_services")
 
 def main():
     try:
@@ -51,7 +71,7 @@ def main():
 
         # Modify any items below surrounded by brackets (<...>) to match your environment
         
-        # The overwrite_service function is based on the following:
+        # The overwrite_services function is based on the following:
         #   -all pro project folders are in a single parent folder
         #   -each pro project folder name exactly matches the associated service name
         #   -each pro project contains a map whose name exactly matches the associated service name
@@ -69,7 +89,11 @@ def main():
         max_record_count = "4000" # example: 4000
 
         # Inser the URL of your ArcGIS REST services directory below
-        svc_directory = ServicesDirectory("<ArcGIS REST Services Directory>") # example: https://maps.fishers.in.us/arcgis/rest/services
+        svc_directory_url = "<ArcGIS REST Services Directory>" # example: https://maps.fishers.in.us/arcgis/rest/services
+
+        # The services directory listing is cached to services_cache.json next to the script for an hour
+        # Run the script with --refresh-cache to request the services directory again
+        refresh_cache = "--refresh-cache" in sys.argv
 
         # The following counters help with testing and allow you to specify a range of services on which to run
         # the code. For example, when running for the first time, you might like to test it on just the first 5
@@ -79,52 +103,121 @@ def main():
         start = 1 # the service you would like to start
         end = 200 # the number of the service you would like to end before
 
+        # Number of services to build and stage at the same time (local work)
+        stage_workers = 4 # example: 4
+        # Number of services to upload at the same time. Keep this low, as ArcGIS Server throttles
+        # concurrent publishing requests
+        upload_workers = 2 # example: 2
+
         # Start a simple log file in the same folder as the script
         nowstart = datetime.datetime.now()
         time_stamp = nowstart.strftime("%Y_%m%d_%H%M")
         log_full_name = script_full_path[:-3] + "_log_" + time_stamp + ".txt"
         log_file = open(log_full_name, "w")      
+        atexit.register(log_file.close) # Writes any buffered log lines when the script exits
+
+        # Start the console message listener
+        log_queue = queue.Queue()
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter("%(message)s"))
+        listener = logging.handlers.QueueListener(log_queue, console_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        logger.setLevel(logging.INFO)
 
         # Get running, non-cached, public map services from your REST services directory
         # To get the full list of running non-cached map services, use the following
-        svc_names = [svc.url.split("/")[-2] for svc in svc_directory.list() if "MapServer" in svc.url and not '"singleFusedMapCache": true' in str(svc.properties)] #production
+        svc_names = [svc["url"].split("/")[-2] for svc in load_services_cached(svc_directory_url, refresh=refresh_cache) if "MapServer" in svc["url"] and not svc["cached"]] #production
 
         # To test and run on a single specific service, uncomment the line below and insert the name of the service
 ##        svc_names = ["Addresses_Demo"] #example: Addresses
 
-        # For each service, pass it to the overwrite_service function
+        # For each service, pass it to the overwrite_services function
         log_results(log_file, "Overwriting services...", True)
         counter = start
         for service_name in svc_names[start-1:end-1]:
             log_results(log_file, f"   {counter}-service_name: {service_name}", True)
             counter += 1
-            # If the overwrite_service function is successful, continue to the next service, if not successful, stop the script
-            # To test stepping through your services and writing their number and name, leave the following four lines commented
-            # When you are ready to execute the overwrite, uncomment the following four lines
-##            if overwrite_service(service_name, target_server_connection, pro_project_parent_dir, out_draft_dir, max_record_count, log_file): pass
-##            else:
-##                log_results(log_file, "      Script Terminated", True)
-##                return
+        # Stage up to stage_workers services while uploading up to upload_workers staged services at the same time
+        # If an overwrite is not successful, stop the script (services already being staged or uploaded are allowed
+        # to finish, services not yet started are skipped)
+        # To test stepping through your services and writing their number and name, leave the following four lines commented
+        # When you are ready to execute the overwrite, uncomment the following four lines
+##        if overwrite_services(svc_names[start-1:end-1], target_server_connection, pro_project_parent_dir, out_draft_dir, max_record_count, log_file, stage_workers, upload_workers): pass
+##        else:
+##            log_results(log_file, "      Script Terminated", True, flush=True)
+##            return
 
     except Exception as e:
-        if type(e) is arcpy.ExecuteError:
-            log_results(log_file, f"{arcpy.GetMessages(2)}", True)
-        tb = sys.exc_info()[2]
-        log_results(log_file, f"ERROR @ Line {tb.tb_lineno}", True)
-        log_results(log_file, f"ERROR: {sys.exc_info()[1]}", True)
+        lineno = e.__traceback__.tb_lineno if e.__traceback__ else -1
+        log_results(log_file, f"ERROR @ Line {lineno}", True)
+        log_results(log_file, f"ERROR: {e}", True, flush=True)
+
+def overwrite_services(services, server_connection, input_dir, output_draft_dir, record_count, log_file, stage_workers, upload_workers):
+    # Pipeline the overwrite: one thread pool builds and stages .sd files (local work) while a second, smaller
+    # thread pool uploads the staged .sd files (network work), connected by a queue of staged files
+    # If any service fails, services not yet staged or uploaded are skipped (and logged as skipped) and False is returned
+    staged = queue.Queue()
+    failed = threading.Event()
 
-def overwrite_service(service, server_connection, input_dir, output_draft_dir, record_count, log_file):
+    # Errors outside build_sddraft, stage_sd, and upload_sd (such as a failed log write) would otherwise end the
+    # thread silently, so they mark the run as failed before being logged
+    def prepare(service):
+        try:
+            if failed.is_set():
+                log_results(log_file, f"      {service}: Skipped (not staged) because an earlier service failed", True)
+                return
+            log_results(log_file, f"   {service}...", True)
+            sddraft_output_filename = build_sddraft(service, server_connection, input_dir, output_draft_dir, record_count, log_file)
+            sd_output_filename = stage_sd(service, sddraft_output_filename, log_file) if sddraft_output_filename is not None else None
+            if sd_output_filename is not None:
+                staged.put((service, sd_output_filename))
+            else:
+                failed.set()
+        except Exception as e:
+            failed.set()
+            log_exception(log_file, service, e)
+
+    def upload():
+        while True:
+            item = staged.get()
+            if item is None: return
+            service, sd_output_filename = item
+            try:
+                if failed.is_set():
+                    log_results(log_file, f"      {service}: Skipped (staged but not uploaded) because an earlier service failed", True)
+                    continue
+                if not upload_sd(service, sd_output_filename, server_connection, log_file):
+                    failed.set()
+            except Exception as e:
+                failed.set()
+                log_exception(log_file, service, e)
+
+    with ThreadPoolExecutor(max_workers=upload_workers) as uploaders:
+        for i in range(upload_workers):
+            uploaders.submit(upload)
+        with ThreadPoolExecutor(max_workers=stage_workers) as stagers:
+            for service in services:
+                stagers.submit(prepare, service)
+        # All services are staged, tell each uploader to stop once the queue is empty
+        for i in range(upload_workers):
+            staged.put(None)
+
+    return not failed.is_set()
+
+def build_sddraft(service, server_connection, input_dir, output_draft_dir, record_count, log_file):
+    # Create the .sddraft file for a service and set its properties. Returns the .sddraft file name, or None if not successful
     try:
-        log_results(log_file, f"   {service}...", True)
         # Set output file names
         sddraft_output_filename = os.path.join(output_draft_dir, f"{service}.sddraft")
         sd_output_filename = os.path.join(output_draft_dir, f"{service}.sd")
 
         # Create output drafts folder if it does not exist
         if not os.path.exists(output_draft_dir):
-            log_results(log_file, f"      Output Drafts folder did not exist", True)
-            log_results(log_file, f"         Creating {output_draft_dir}...", True)
-            os.makedirs(output_draft_dir)
+            log_results(log_file, f"      {service}: Output Drafts folder did not exist", True)
+            log_results(log_file, f"         {service}: Creating {output_draft_dir}...", True)
+            os.makedirs(output_draft_dir, exist_ok=True)
         
         # Delete previous output files if they exist
         for s in (sddraft_output_filename, sd_output_filename):
@@ -132,13 +225,13 @@ def overwrite_service(service, server_connection, input_dir, output_draft_dir, r
                 os.remove(s)
 
         # Reference map to publish
-        log_results(log_file, "      Getting project and map...", True)
+        log_results(log_file, f"      {service}: Getting project and map...", True)
         aprx_name = service + ".aprx"
         aprx = arcpy.mp.ArcGISProject(os.path.join(input_dir, service, aprx_name))
         m = aprx.listMaps(service)[0]
 
         # Create MapServiceDraft, set overwrite property, set metadata
-        log_results(log_file, "      Creating sddraft and setting metadata...", True)
+        log_results(log_file, f"      {service}: Creating sddraft and setting metadata...", True)
         sddraft = arcpy.sharing.CreateSharingDraft("STANDALONE_SERVER", "MAP_SERVICE", service, m)
         sddraft.targetServer = server_connection
         sddraft.overwriteExistingService = True
@@ -147,56 +240,97 @@ def overwrite_service(service, server_connection, input_dir, output_draft_dir, r
         sddraft.exportToSDDraft(sddraft_output_filename)
 
         # parse XML and change properties to use the shared instance and set the Max Records Returned
-        xml = sddraft_output_filename
-        doc = DOM.parse(xml)
-        def_childnodes = doc.getElementsByTagName("Definition")[0].childNodes
-        log_results(log_file, "      Changing service properties...", True)
-        for def_node in def_childnodes:
-            # Change provider to shared instance
-            if def_node.nodeName == "Props":
-                for node in def_node.childNodes[0].childNodes:
-                    # Change the provider to modify instance type
-                    # provider="DMaps" for shared or "ArcObjects11" for dedicated
-                    if node.firstChild.firstChild.data == "provider":
-                        log_results(log_file, "         Setting Provider to shared instance...", True)
-                        node.lastChild.firstChild.data = "DMaps"
-            # Change the maxRecordCount
-            if def_node.nodeName == "ConfigurationProperties":
-                for node in def_node.childNodes[0].childNodes:
-                    if node.firstChild.firstChild.data == "maxRecordCount":
-                        log_results(log_file, f"         Setting MaxRecordCount to {record_count}", True)
-                        node.lastChild.firstChild.data = record_count
-                        
-                        
+        # The exported file is read once into memory, edited, and written back once
+        with open(sddraft_output_filename, "rb") as f:
+            sddraft_data = f.read()
+        if etree is not None:
+            root = etree.fromstring(sddraft_data)
+            definition = root.find(".//Definition") # Matches the first Definition element, as getElementsByTagName does below
+            def index_propset(parent_tag):
+                # Map each property key in the property set to its Value element in a single pass
+                return {node.findtext("Key"): node.find("Value") for node in definition.iterfind(f"{parent_tag}/PropertyArray/PropertySetProperty")}
+            def set_value(value_node, value):
+                value_node.text = value
+        else:
+            doc = DOM.parseString(sddraft_data)
+            def_nodes = {def_node.nodeName: def_node for def_node in doc.getElementsByTagName("Definition")[0].childNodes}
+            def index_propset(parent_tag):
+                # Map each property key in the property set to its Value element in a single pass
+                # A missing property set gives an empty dictionary, so its properties are skipped
+                pset = def_nodes.get(parent_tag)
+                if pset is None: return {}
+                return {node.firstChild.firstChild.data: node.lastChild for node in pset.childNodes[0].childNodes}
+            def set_value(value_node, value):
+                value_node.firstChild.data = value
+        log_results(log_file, f"      {service}: Changing service properties...", True)
+        # Change the provider to modify instance type
+        # provider="DMaps" for shared or "ArcObjects11" for dedicated
+        props = index_propset("Props")
+        if "provider" in props:
+            log_results(log_file, f"         {service}: Setting Provider to shared instance...", True)
+            set_value(props["provider"], "DMaps")
+        # Change the maxRecordCount
+        config_props = index_propset("ConfigurationProperties")
+        if "maxRecordCount" in config_props:
+            log_results(log_file, f"         {service}: Setting MaxRecordCount to {record_count}", True)
+            set_value(config_props["maxRecordCount"], record_count)
+
         # Write to the .sddraft file
-        log_results(log_file, "      Writing sddraft...", True)
-        f = open(sddraft_output_filename, "w")
-        doc.writexml(f)
-        f.close()
+        log_results(log_file, f"      {service}: Writing sddraft...", True)
+        if etree is not None:
+            sddraft_data = etree.tostring(root, xml_declaration=True, encoding="utf-8")
+        else:
+            sddraft_data = doc.toxml(encoding="utf-8")
+        # Write to a temporary file first so a failed write never leaves a partial .sddraft file
+        with open(sddraft_output_filename + ".tmp", "wb") as f:
+            f.write(sddraft_data)
+        os.replace(sddraft_output_filename + ".tmp", sddraft_output_filename)
+
+        return sddraft_output_filename
 
-        # Stage Service
-        log_results(log_file, "      Staging...", True)
+    except Exception as e:
+        log_exception(log_file, service, e)
+        return None
+
+def stage_sd(service, sddraft_output_filename, log_file):
+    # Stage the service (convert the .sddraft to an .sd file). Returns the .sd file name, or None if not successful
+    try:
+        log_results(log_file, f"      {service}: Staging...", True)
+        sd_output_filename = os.path.splitext(sddraft_output_filename)[0] + ".sd"
         arcpy.server.StageService(sddraft_output_filename, sd_output_filename)
-        
-        # Publish to server
-        log_results(log_file, "      Uploading...", True)
+        return sd_output_filename
+
+    except Exception as e:
+        log_exception(log_file, service, e)
+        return None
+
+def upload_sd(service, sd_output_filename, server_connection, log_file):
+    # Publish the staged .sd file to the server. Returns True if successful
+    try:
+        log_results(log_file, f"      {service}: Uploading...", True)
         arcpy.server.UploadServiceDefinition(sd_output_filename, server_connection)
     
-        log_results(log_file, "      Finished Publishing", True)
+        log_results(log_file, f"      {service}: Finished Publishing", True, flush=True)
         return True
-    
+
     except Exception as e:
-        if type(e) is arcpy.ExecuteError:
-            log_results(log_file, f"      {arcpy.GetMessages(2)}", True)
-        tb = sys.exc_info()[2]
-        log_results(log_file, f"      ERROR @ Line {tb.tb_lineno}", True)
-        log_results(log_file, f"      ERROR: {sys.exc_info()[1]}", True)
+        log_exception(log_file, service, e)
         return False
+
+def log_exception(log_file, service, e):
+    # For arcpy.ExecuteError, str(e) holds the failing tool's messages. arcpy.GetMessages is not used, as it returns
+    # the messages of whichever tool ran last in the process, which may belong to another service's thread
+    lineno = e.__traceback__.tb_lineno if e.__traceback__ else -1 # Read from the exception itself, as several threads may be handling errors
+    log_results(log_file, f"      {service}: ERROR @ Line {lineno}", True)
+    log_results(log_file, f"      {service}: ERROR: {e}", True, flush=True)
+    return
         
-def log_results(file, message, echo=False):
-    if echo: print(message)
-    file.write(f"{message}\n")
-    file.flush()
+def log_results(file, message, echo=False, flush=False):
+    # Log lines are buffered. Pass flush=True at the end of each service so the log is on disk at each checkpoint
+    with log_lock:
+        if echo: logger.info(message)
+        file.write(f"{message}\n")
+        if flush: file.flush()
     return
 
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+## services_cache.py
+## Purpose: Shared by MXD-TO-APRX.py and overwrite_map_services.py. Caches the list of services from an ArcGIS REST Services Directory
+##          to a local JSON file so reruns do not need to request the directory listing and the properties of every service again.
+##          Pass --refresh-cache to either script to ignore the cached file.
+
+import os, json, time, tempfile
+from arcgis.gis.server.catalog import ServicesDirectory
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "services_cache.json")
+
+def _is_cached(service):
+
+    """Reads the singleFusedMapCache property directly rather than searching the text of every service property. Falls back to the text search if the properties do not support key lookups."""
+
+    try:
+        return service.properties.get("singleFusedMapCache", False) is True
+    except AttributeError:
+        return '"singleFusedMapCache": true' in str(service.properties)
+
+def load_services_cached(url, ttl=3600, refresh=False):
+
+    """Returns a list of {"url": ..., "cached": ...} dictionaries for every service in the REST Services Directory. Reads the cache file if it was written for the same URL within the last ttl seconds, otherwise requests the services directory and rewrites the cache file."""
+
+    if not refresh and os.path.exists(CACHE_FILE):
+        try:
+            if time.time() - os.path.getmtime(CACHE_FILE) < ttl:
+                with open(CACHE_FILE, "r") as cache_file:
+                    cache = json.load(cache_file)
+                if cache["rest_url"] == url:
+                    return cache["services"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass # Unreadable cache files are replaced below
+
+    # Properties are only read for MapServer entries, as reading them may request each service from the server
+    services = [{"url": service.url, "cached": "MapServer" in service.url and _is_cached(service)} for service in ServicesDirectory(url).list()]
+    # A failed cache write (read-only folder, file in use by the other script) does not affect the listing just received
+    try:
+        temp_handle, temp_file = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(CACHE_FILE)) # Unique name, so both scripts can write at the same time
+        try:
+            with os.fdopen(temp_handle, "w") as cache_file:
+                json.dump({"rest_url": url, "services": services}, cache_file)
+            os.replace(temp_file, CACHE_FILE) # Replaces the cache file in one step so an interrupted run never leaves a partial file
+        except OSError:
+            os.remove(temp_file)
+            raise
+    except OSError:
+        pass
+
+    return services